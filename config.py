@@ -31,11 +31,15 @@
 
 # pylint: disable=W0612
 
+import hashlib
+import threading
+
 from supybot import conf
 from supybot import registry
 
 _URL_TEXT = ''' Bugzilla url e. g.,
- https://bugzilla.redhat.com/xmlrpc.cgi. '''
+ https://bugzilla.redhat.com/xmlrpc.cgi. Recorded data can be used
+ with file://<dataset> or replay://<snapshots glob pattern>. '''
 
 _CHANNELS_TXT = """ The channels receiving data from a watch. """
 
@@ -46,18 +50,79 @@ _FIRSTBUG_TXT = """The id of the first bug we care about,
  older bugs are silently dropped. Use to limit the number of bugs
  retrieved from bugzilla and related timeouts."""
 
+
+def _invalidating(cls):
+    ''' Return a subclass of registry class cls which drops all cached
+    watch configs (see watch_config()) when the value is changed.
+    '''
+
+    class _Invalidating(cls):
+        ''' A cls which invalidates cached watch configs on change. '''
+        # pylint: disable=W0232
+
+        def setValue(self, v):
+            cls.setValue(self, v)
+            invalidate_watch()
+
+    return _Invalidating
+
+
+_String = _invalidating(registry.String)
+_Boolean = _invalidating(registry.Boolean)
+_NonNegativeInteger = _invalidating(registry.NonNegativeInteger)
+_SpaceSeparatedListOfStrings = \
+    _invalidating(registry.SpaceSeparatedListOfStrings)
+
+_REPLAYPERIOD_TXT = """ For replay:// urls: the number of seconds each
+ recorded snapshot is served. Zero steps to next snapshot on each poll."""
+
+_REPORTREMOVED_TXT = """ Report bugs which no longer match the query e.
+ g., when closed, using removedformat."""
+
+_FORMAT_TXT = """ Template for %s. Fields: $id, $short_desc,
+ $status, $url, $author (last commenter), $attachments and $comments
+ (counts)."""
+
 _WATCH_OPTIONS = {
     'url':
-        lambda: registry.String('', _URL_TEXT),
+        lambda: _String('', _URL_TEXT),
     'firstbug':
-        lambda: registry.NonNegativeInteger(0, _FIRSTBUG_TXT),
+        lambda: _NonNegativeInteger(0, _FIRSTBUG_TXT),
     'channels':
-        lambda: registry.SpaceSeparatedListOfStrings('', _CHANNELS_TXT),
+        lambda: _SpaceSeparatedListOfStrings('', _CHANNELS_TXT),
     'query':
-        lambda: registry.SpaceSeparatedListOfStrings('*', _QUERY_TXT),
+        lambda: _SpaceSeparatedListOfStrings('*', _QUERY_TXT),
+    'replayperiod':
+        lambda: _NonNegativeInteger(0, _REPLAYPERIOD_TXT),
+    'newbugformat':
+        lambda: _String('New bug: $id: $short_desc - $url',
+                        _FORMAT_TXT % 'new bug notifications'),
+    'statusformat':
+        lambda: _String(
+                    'Bug $id: $short_desc, new state: $status - $url',
+                    _FORMAT_TXT % 'bug status change notifications'),
+    'commentformat':
+        lambda: _String(
+                    'Bug $id: $short_desc, new comment from: $author - $url',
+                    _FORMAT_TXT % 'new comment notifications'),
+    'reportremoved':
+        lambda: _Boolean(False, _REPORTREMOVED_TXT),
+    'removedformat':
+        lambda: _String('Bug $id: $short_desc, left watch - $url',
+                        _FORMAT_TXT % 'bugs leaving the watch'),
+    'snarfformat':
+        lambda: _String(
+                    '$id: $short_desc - $status - $attachments attachments'
+                        ' - $comments comments - $url',
+                    _FORMAT_TXT % 'replies on bug ids found in chat'),
 }
 
 
+class _FetchEngine(registry.OnlySomeStrings):
+    ''' Valid values are 'threaded' and 'pooled'. '''
+    validStrings = ('threaded', 'pooled')
+
+
 def global_option(option):
     ''' Return an overall plugin option (registered at load time). '''
     return conf.supybot.plugins.get('bz').get(option)
@@ -77,8 +142,65 @@ def watch_option(watchname, option):
         return watch.get(option)
 
 
+class WatchConfig(object):
+    """
+    Resolved, read-only settings for a watch. Use watch_config() to
+    get a cached instance, rebuilt after any watch option is changed.
+    """
+    # pylint: disable=R0902
+
+    def __init__(self, watchname):
+        self.name = watchname
+        self.url = watch_option(watchname, 'url').value
+        self.firstbug = watch_option(watchname, 'firstbug').value
+        self.channels = list(watch_option(watchname, 'channels').value)
+        self.query = list(watch_option(watchname, 'query').value)
+        self.replayperiod = watch_option(watchname, 'replayperiod').value
+        self.newbugformat = watch_option(watchname, 'newbugformat').value
+        self.statusformat = watch_option(watchname, 'statusformat').value
+        self.commentformat = watch_option(watchname, 'commentformat').value
+        self.snarfformat = watch_option(watchname, 'snarfformat').value
+        self.reportremoved = watch_option(watchname, 'reportremoved').value
+        self.removedformat = watch_option(watchname, 'removedformat').value
+        self.fingerprint = hashlib.sha1(
+            ' '.join(sorted(self.query) + [str(self.firstbug)])).hexdigest()
+        self._query_dict = None
+
+    def query_dict(self):
+        ''' Return a copy of the parsed query, throws ValueError. '''
+        if self._query_dict is None:
+            dict_ = {}
+            for item in self.query:
+                key, value = item.split(':', 1)
+                dict_[key] = value
+            self._query_dict = dict_
+        return dict(self._query_dict)
+
+
+_watch_configs = {}
+_watch_configs_lock = threading.RLock()
+
+
+def watch_config(watchname):
+    ''' Return the cached WatchConfig for a watch, building it if required. '''
+    with _watch_configs_lock:
+        if watchname not in _watch_configs:
+            _watch_configs[watchname] = WatchConfig(watchname)
+        return _watch_configs[watchname]
+
+
+def invalidate_watch(watchname=None):
+    ''' Drop cached config for given watch, or all if None. '''
+    with _watch_configs_lock:
+        if watchname is None:
+            _watch_configs.clear()
+        else:
+            _watch_configs.pop(watchname, None)
+
+
 def unregister_watch(watchname):
     ''' Unregister  watch from registry. '''
+    invalidate_watch(watchname)
     try:
         global_option('watches').unregister(watchname)
     except registry.NonExistentRegistryEntry:
@@ -103,5 +225,34 @@ conf.registerGlobalValue(Bz, 'pollPeriod',
     registry.NonNegativeInteger(600, """ How often (in seconds) that
   bugzillas will be polled for changes. Zero disables periodic polling."""))
 
+conf.registerGlobalValue(Bz, 'workerProcesses',
+    registry.NonNegativeInteger(0, """ Number of worker processes reading,
+  comparing and saving bugs outside the bot process. Zero (default) does
+  this in the bot process. Changes take effect after 'reload Bz'."""))
+
+conf.registerGlobalValue(Bz, 'fetchEngine',
+    _FetchEngine('threaded', """ How bugzillas are polled: 'threaded'
+  uses python-bugzilla in one thread, 'pooled' runs concurrent XML-RPC
+  requests over a few connections per bugzilla."""))
+
+conf.registerGlobalValue(Bz, 'fetchConnections',
+    registry.PositiveInteger(4, """ Number of connections to each bugzilla
+  used by the pooled fetchEngine."""))
+
+conf.registerGlobalValue(Bz, 'fetchTimeout',
+    registry.PositiveInteger(120, """ Timeout (in seconds) for each
+  request made by the pooled fetchEngine."""))
+
+conf.registerGlobalValue(Bz, 'fetchChunk',
+    registry.PositiveInteger(200, """ Max number of bugs in each request
+  made when fetching. Background polls give way to interactive commands
+  between such requests, with workerProcesses and the threaded
+  fetchEngine only between watches."""))
+
+conf.registerGlobalValue(Bz, 'sharedStore',
+    registry.String('', """ Path to a file shared by several bots on
+  this host watching the same bugs. Only one of them polls bugzilla, the
+  others read the changes it finds from this file. Empty: disabled."""))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,221 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Recorded bug datasets, used to replay captured bugzilla data through
+file:// and replay:// watch urls.
+
+A dataset is either a pickled list of bugs (as in testdata/), a saved
+watch state (a bz.<watch>.pickle file) or a sharded directory. A
+sharded directory holds an 'index' file and a number of shard files,
+each a pickled list of bugs sorted by id and covering a distinct id
+range. Only the index is read up front. Shards are unpickled one at a
+time when iterated, and shards with ids below firstbug are never read.
+
+Create a sharded dataset from a pickled list or watch state, in the
+supybot directory:
+
+    $ python plugins/Bz/dataset.py bz.test1.pickle bz.test1.d [shard size]
+"""
+
+import bisect
+import cPickle as pickle
+import glob
+import os
+import re
+import sys
+import time
+
+INDEX = 'index'
+VERSION = 1
+SHARD_SIZE = 1000
+
+
+def write(bugs, path, shard_size=SHARD_SIZE):
+    ''' Write bugs as a sharded dataset in directory path. '''
+    bugs = sorted(bugs, key=lambda b: b.id)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    shards = []
+    for start in range(0, len(bugs), shard_size):
+        chunk = bugs[start:start + shard_size]
+        filename = 'shard.%05d' % len(shards)
+        with open(os.path.join(path, filename), 'wb') as f:
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+        shards.append((chunk[0].id, chunk[-1].id, len(chunk), filename))
+    tmp = os.path.join(path, INDEX + '.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': VERSION, 'shards': shards}, f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, os.path.join(path, INDEX))
+
+
+def is_sharded(path):
+    ''' Return True if path is a sharded dataset directory. '''
+    return os.path.isfile(os.path.join(path, INDEX))
+
+
+class Dataset(object):
+    ''' A sharded dataset, shards are loaded lazily when iterated. '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX), 'rb') as f:
+            index = pickle.load(f)
+        if index.get('version') != VERSION:
+            raise ValueError("Unsupported dataset version in " + path)
+        self.shards = index['shards']
+        self._last_ids = [s[1] for s in self.shards]
+
+    def __len__(self):
+        return sum([s[2] for s in self.shards])
+
+    def _load_shard(self, filename):
+        ''' Return the list of bugs in a shard. '''
+        with open(os.path.join(self.path, filename), 'rb') as f:
+            return pickle.load(f)
+
+    def bugs(self, firstbug=0):
+        ''' Iterate bugs with id >= firstbug in id order. '''
+        first = bisect.bisect_left(self._last_ids, firstbug)
+        for shard in self.shards[first:]:
+            for bug in self._load_shard(shard[3]):
+                if bug.id >= firstbug:
+                    yield bug
+
+
+def iterate(path, firstbug=0):
+    """
+    Iterate bugs with id >= firstbug in a dataset path. A sharded
+    dataset is read one shard at a time.
+    """
+    if is_sharded(path):
+        return Dataset(path).bugs(firstbug)
+    with open(path, 'rb') as f:
+        bugs = pickle.load(f)
+    if isinstance(bugs, dict):
+        # A saved watch state, or just its dict of bugs by id.
+        if 'version' in bugs:
+            bugs = bugs['bugs']
+        bugs = sorted(bugs.values(), key=lambda b: b.id)
+    return iter([b for b in bugs if b.id >= firstbug])
+
+
+def load(path, firstbug=0):
+    ''' Return list of bugs with id >= firstbug from a dataset path. '''
+    return list(iterate(path, firstbug))
+
+
+def load_state(path):
+    """
+    Return the saved watch state in path, a dict with 'bugs' (dict of
+    bugs by id), 'fingerprint' (of the query and firstbug the bugs were
+    fetched with) and 'shared_seq' (last sharedStore event applied, None
+    if unknown).
+    Throws IOError, ValueError, EOFError.
+    """
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if isinstance(state, list):
+        state = dict([(b.id, b) for b in state])
+    if 'version' not in state:
+        # Just the bugs, from older versions.
+        state = {'bugs': state, 'fingerprint': None}
+    state.setdefault('shared_seq', None)
+    return state
+
+
+def dump_state(path, bugs, fingerprint, shared_seq=None):
+    ''' Write watch state to path, see load_state(). Throws IOError. '''
+    with open(path, 'wb') as f:
+        pickle.dump({'version': 1,
+                     'bugs': bugs,
+                     'fingerprint': fingerprint,
+                     'shared_seq': shared_seq},
+                    f, pickle.HIGHEST_PROTOCOL)
+
+
+def _snapshot_key(path):
+    ''' Sort key ordering snapshots like bz.x.pickle.2 < bz.x.pickle.10. '''
+    match = re.search(r'(\d+)$', path.rstrip('/'))
+    return (int(match.group(1)) if match else -1, path)
+
+
+class Replay(object):
+    """
+    A sequence of snapshots matching a glob pattern, replayed as a
+    stream. Each snapshot is served for period seconds, or for one
+    read if period is 0. The last snapshot is served forever after.
+    """
+
+    def __init__(self, pattern, period=0):
+        self.pattern = pattern
+        self.period = period
+        self.paths = sorted(glob.glob(pattern), key=_snapshot_key)
+        if not self.paths:
+            raise ValueError("No snapshots matching " + pattern)
+        self._start = None
+        self._reads = 0
+
+    def current(self):
+        ''' Return path to the snapshot to serve right now. '''
+        if self._start is None:
+            self._start = time.time()
+        if self.period:
+            step = int((time.time() - self._start) / self.period)
+        else:
+            step = self._reads
+        self._reads += 1
+        return self.paths[min(step, len(self.paths) - 1)]
+
+
+def main(argv):
+    ''' Split a pickled bug list or watch state into a sharded dataset. '''
+    # pylint: disable=W0611
+    if len(argv) not in (3, 4):
+        sys.stderr.write(
+            "Usage: dataset.py <pickle> <directory> [shard size]\n")
+        return 1
+    # The pickled bugs are Bz.plugin._PickleBug instances.
+    import supybot.world
+    plugins = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, plugins)
+    import Bz.plugin
+    shard_size = int(argv[3]) if len(argv) == 4 else SHARD_SIZE
+    bugs = load(argv[1])
+    write(bugs, argv[2], shard_size)
+    print "Wrote %d bugs to %s" % (len(bugs), argv[2])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
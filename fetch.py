@@ -0,0 +1,300 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Pooled fetch engine, an alternative to the python-bugzilla based
+fetching in plugin.py. Talks XML-RPC to bugzilla directly.
+
+An Engine keeps a pool of a few worker threads per bugzilla url. Each
+worker owns one persistent (keep-alive) connection, and all workers
+serve a common request queue. Requests are submitted without waiting,
+so the searches for all watches and then all chunked Bug.get,
+Bug.comments and Bug.attachments calls are in flight at the same time.
+Each request has its own socket timeout.
+"""
+
+import httplib
+import Queue
+import socket
+import ssl
+import threading
+import time
+import xmlrpclib
+
+from supybot import log
+
+
+class FetchError(Exception):
+    ''' A failed bugzilla request. '''
+    pass
+
+
+class Bug(object):
+    ''' Bug data as returned by the engine, same fields as plugin.py. '''
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _timeout_transport(base):
+    ''' Return a subclass of xmlrpclib transport base using a timeout. '''
+
+    class _TimeoutTransport(base):
+        ''' A base transport which sets a timeout on its connection. '''
+
+        def __init__(self, timeout):
+            base.__init__(self)
+            self.timeout = timeout
+
+        def make_connection(self, host):
+            conn = base.make_connection(self, host)
+            conn.timeout = self.timeout
+            if conn.sock:
+                conn.sock.settimeout(self.timeout)
+            return conn
+
+    return _TimeoutTransport
+
+
+_Transport = _timeout_transport(xmlrpclib.Transport)
+_SafeTransport = _timeout_transport(xmlrpclib.SafeTransport)
+
+
+class _Call(object):
+    """
+    A submitted request, result() blocks until it's done or the
+    deadline (a time.time() value) has passed.
+    """
+
+    def __init__(self, method, params, deadline):
+        self.method = method
+        self.params = params
+        self.deadline = deadline
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def finish(self, result=None, error=None):
+        ''' Store outcome, wake up waiters. '''
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        ''' Wait for call to complete, return result or raise FetchError. '''
+        if not self._done.wait(max(self.deadline - time.time(), 0)):
+            raise FetchError('%s: no response' % self.method)
+        if self._error:
+            raise FetchError(self._error)
+        return self._result
+
+
+class _Pool(object):
+    ''' Worker threads sharing a request queue, one connection each. '''
+
+    def __init__(self, url, size, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.log = log.getPluginLogger('bz.fetch')
+        self._queue = Queue.Queue()
+        self._workers = []
+        for i in range(0, size):
+            worker = threading.Thread(target=self._serve,
+                                      args=(timeout,),
+                                      name='bz-fetch-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _serve(self, timeout):
+        ''' Worker thread main loop, None in queue means exit. '''
+        if self.url.startswith('https'):
+            transport = _SafeTransport(timeout)
+        else:
+            transport = _Transport(timeout)
+        proxy = xmlrpclib.ServerProxy(self.url,
+                                      transport=transport,
+                                      allow_none=True)
+        while True:
+            call = self._queue.get()
+            if call is None:
+                break
+            # pylint: disable=W0703
+            try:
+                call.finish(getattr(proxy, call.method)(call.params))
+            except (xmlrpclib.Error, httplib.HTTPException,
+                    socket.error, ssl.SSLError) as e:
+                transport.close()
+                self.log.debug("%s failed: %s" % (call.method, str(e)))
+                call.finish(error='%s: %s' % (call.method, str(e)))
+            except Exception as e:
+                # E. g., a malformed response. Never let the worker die
+                # with the call unfinished.
+                transport.close()
+                self.log.warning("%s failed: %s" % (call.method, str(e)),
+                                 exc_info=True)
+                call.finish(error='%s: %s' % (call.method, str(e)))
+        transport.close()
+
+    def submit(self, method, params):
+        """
+        Queue a request, return a _Call to wait on. Each request should
+        be done in timeout, the deadline allows for those ahead in the
+        queue and some slack.
+        """
+        ahead = self._queue.qsize() / len(self._workers)
+        deadline = time.time() + 2 * self.timeout * (ahead + 1)
+        call = _Call(method, params, deadline)
+        self._queue.put(call)
+        return call
+
+    def close(self):
+        ''' Let all workers exit after current requests. '''
+        for dummy in self._workers:
+            self._queue.put(None)
+
+
+class _Fetch(object):
+    ''' Fetching of all bugs for one query, driven by Engine.fetch_all(). '''
+
+    def __init__(self, pool, query, firstbug, known):
+        self.pool = pool
+        self.firstbug = firstbug
+        self.known = known
+        self.ids = None
+        query = dict(query)
+        query['include_fields'] = ['id', 'last_change_time']
+        self._search = pool.submit('Bug.search', query)
+        self._chunks = []
+
+    def submit_gets(self, chunk_size):
+        """
+        Wait for the search, submit requests for all found bugs which
+        are new or have a changed last_change_time.
+        """
+        found = [b for b in self._search.result()['bugs']
+                     if b['id'] > self.firstbug]
+        self.ids = [b['id'] for b in found]
+        changed = [b['id'] for b in found
+                       if self.known.get(b['id']) !=
+                           str(b.get('last_change_time'))]
+        for i in range(0, len(changed), chunk_size):
+            chunk = changed[i:i + chunk_size]
+            self._chunks.append((
+                self.pool.submit('Bug.get',
+                                 {'ids': chunk,
+                                  'include_fields': ['id', 'status',
+                                                     'summary',
+                                                     'last_change_time']}),
+                self.pool.submit('Bug.comments', {'ids': chunk}),
+                self.pool.submit('Bug.attachments',
+                                 {'ids': chunk, 'include_fields': ['id']})))
+
+    def result(self, checkpoint):
+        """
+        Wait for all requests, calling checkpoint() before each chunk.
+        Return (all found ids, list of Bug).
+        """
+        bugs = []
+        url = self.pool.url
+        for get, comments, attachments in self._chunks:
+            checkpoint()
+            comments = comments.result()['bugs']
+            attachments = attachments.result()['bugs']
+            for b in get.result()['bugs']:
+                id_ = str(b['id'])
+                longdescs = []
+                for c in comments.get(id_, {}).get('comments', []):
+                    c = dict(c)
+                    c['author'] = c.get('creator', c.get('author'))
+                    longdescs.append(c)
+                bugs.append(Bug(
+                    id=b['id'],
+                    last_change_time=b.get('last_change_time'),
+                    status=b['status'],
+                    short_desc=b['summary'],
+                    url=url.replace('xmlrpc.cgi',
+                                    'show_bug.cgi?id=%d' % b['id']),
+                    attachments=attachments.get(id_, []),
+                    longdescs=longdescs))
+        return self.ids, bugs
+
+
+class Engine(object):
+    """
+    Connection pools for all bugzilla urls in use, shared by all
+    fetch cycles until closed.
+    """
+
+    def __init__(self, connections, timeout, chunk_size):
+        self.connections = connections
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._pools = {}
+
+    def _pool(self, url):
+        ''' Return pool for url, created on first use. '''
+        if url not in self._pools:
+            self._pools[url] = _Pool(url, self.connections, self.timeout)
+        return self._pools[url]
+
+    def fetch_all(self, requests, checkpoint=lambda: None):
+        """
+        Fetch bugs for a list of (url, query dict, firstbug, known)
+        requests, where known is a dict of last change times by id for
+        bugs which need not be fetched unless changed. Returns a list
+        with, for each request, a FetchError or a tuple with all found
+        ids and a list of the fetched Bug. checkpoint() is called before
+        waiting for each search and each chunk of bugs.
+        """
+        fetches = [_Fetch(self._pool(url), query, firstbug, known)
+                       for url, query, firstbug, known in requests]
+        results = [None] * len(fetches)
+        for i, fetch in enumerate(fetches):
+            checkpoint()
+            try:
+                fetch.submit_gets(self.chunk_size)
+            except FetchError as e:
+                results[i] = e
+        for i, fetch in enumerate(fetches):
+            if results[i] is None:
+                try:
+                    results[i] = fetch.result(checkpoint)
+                except FetchError as e:
+                    results[i] = e
+        return results
+
+    def close(self):
+        ''' Shut down all pools. '''
+        for pool in self._pools.values():
+            pool.close()
+        self._pools = {}
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,113 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Serializes bugzilla work done by interactive commands and background
+polls, serving interactive commands first.
+"""
+
+import contextlib
+import threading
+import time
+
+
+class Gate(object):
+    """
+    Serializes bugzilla work, serving interactive commands ahead of
+    background polls. A background poll holding the gate yields it to
+    waiting interactive work at checkpoints e. g., between chunks of
+    a fetch. Keeps queue wait statistics for each lane.
+    """
+
+    LANES = ('interactive', 'background')
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = dict([(lane, 0) for lane in self.LANES])
+        self._stats = dict([(lane, [0, 0.0, 0.0]) for lane in self.LANES])
+        self.yields = 0
+
+    def _acquire(self, lane):
+        ''' Wait for the gate, background waits for all interactive. '''
+        start = time.time()
+        with self._cond:
+            self._waiting[lane] += 1
+            while self._busy or \
+                    (lane == 'background' and self._waiting['interactive']):
+                self._cond.wait()
+            self._waiting[lane] -= 1
+            self._busy = True
+            wait = time.time() - start
+            stats = self._stats[lane]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+
+    def _release(self):
+        ''' Let next waiter in. '''
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def interactive(self):
+        ''' Hold the gate for a command run on behalf of a user. '''
+        self._acquire('interactive')
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.contextmanager
+    def background(self):
+        ''' Hold the gate for periodic polling. '''
+        self._acquire('background')
+        try:
+            yield
+        finally:
+            self._release()
+
+    def checkpoint(self):
+        ''' In background(): yield to waiting interactive work, if any. '''
+        with self._cond:
+            if not self._waiting['interactive']:
+                return
+            self.yields += 1
+        self._release()
+        self._acquire('background')
+
+    def stats(self):
+        ''' Return dict of (count, average wait, max wait) by lane. '''
+        with self._cond:
+            return dict([(lane, (s[0], s[1] / s[0] if s[0] else 0.0, s[2]))
+                         for lane, s in self._stats.iteritems()])
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
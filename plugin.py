@@ -34,6 +34,9 @@ certain bugs.  See README for configuration and usage.
 This code is threaded. A separate thread run the potential long-running
 fetching of data from bugzilla. The rest is handled by the main thread.
 
+Optionally, reading, comparing and pickling bugs is done in worker
+processes (see workers.py), returning only the changed fields to the bot.
+
 The critical sections are:
    - The _Watch instances, locked with an instance attribute lock.
    - The _Watches instance (watches) in the Bz class, locked by a
@@ -44,7 +47,6 @@ See: The supybot docs, notably ADVANCED_PLUGIN_CONFIG.rst and
 """
 
 import os
-import pickle
 import ssl
 
 import bugzilla
@@ -54,6 +56,7 @@ from supybot import log
 from supybot import schedule
 from supybot import world
 from supybot import ircmsgs
+from supybot import ircutils
 from supybot.commands import commalist
 from supybot.commands import optional
 from supybot.commands import threading
@@ -62,6 +65,13 @@ from supybot.commands import wrap
 from supybot.utils.str import nItems
 
 import config
+import dataset
+import fetch
+import gate
+import profiling
+import render
+import shared
+import workers
 
 
 HELP_URL = 'https://github.com/leamas/supybot-bz'
@@ -69,73 +79,173 @@ HELP_URL = 'https://github.com/leamas/supybot-bz'
 _FIELDS = ['id', 'status', 'url', 'short_desc', 'attachments', 'longdescs']
 
 
-def _bug_change_msg(bug):
-    ''' Message printed for bugs changing status. '''
-    msg = 'Bug ' + str(bug.id) + ': ' + bug.short_desc + ', new state: ' \
-           + bug.status + ' - ' + bug.url
-    return msg
+def _is_recorded(url):
+    ''' Return True if url refers to recorded data, not a bugzilla. '''
+    return url.startswith('file://') or url.startswith('replay://')
 
 
-def _bug_commented_msg(bug):
-    ''' Message printed for bugs being commented. '''
-    msg = 'Bug ' + str(bug.id) + ': ' + bug.short_desc  \
-           + ', new comment from: ' + bug.longdescs[-1]['author'] \
-           + ' - ' + bug.url
-    return msg
+class BzPluginError(Exception):
+    ''' Common base class for exceptions in this plugin. '''
+    pass
 
 
-def _new_bug_msg(bug):
-    ''' Message printed for new bugs. '''
-    msg = "New bug: " + str(bug.id) + ": "  + bug.short_desc \
-              + ' - ' + bug.url
-    return msg
+class _PickleBug:
+    ''' Simple, non-proxy bug data container. '''
+    pass
 
 
-def _snarf_msg(bug):
-    ''' Message printed if bug id found in irc chat. '''
-    msg = "%d: %s - %s - %d attachments - %d comments - %s" % \
-              (bug.id, bug.short_desc, bug.status, len(bug.attachments),
-                  len(bug.longdescs), bug.url)
-    return msg
+def _change_time(bug):
+    ''' Return last change time of bug as a string, None if unknown. '''
+    value = getattr(bug, 'last_change_time', None)
+    return str(value) if value is not None else None
 
 
-def _send_msg(text, irc, channels):
-    ''' Send text as a to notice to all channels. '''
-    for channel in channels:
-        msg = ircmsgs.notice(channel, text)
-        irc.queueMsg(msg)
+def _change_times(bugs):
+    ''' Return dict of known last change times by id for bugs dict. '''
+    times = {}
+    for id_, bug in bugs.iteritems():
+        value = _change_time(bug)
+        if value:
+            times[id_] = value
+    return times
 
 
-def _on_bug_change(oldbug, newbug, watch, irc):
-    ''' Report diffs in newbug state compared to oldbug. '''
-    channels = config.watch_option(watch.name, 'channels').value
-    if not newbug:
-        watch.log.warning("_on_bug_change: Bad newbug")
-        return
-    if not oldbug:
-        _send_msg(_new_bug_msg(newbug), irc, channels)
-    if oldbug.status != newbug.status:
-        _send_msg(_bug_change_msg(newbug), irc, channels)
-    elif len(oldbug.longdescs) != len(newbug.longdescs):
-        _send_msg(_bug_commented_msg(newbug), irc, channels)
+def _copy_bug(bz_bug):
+    ''' Return bug as PickleBug so that, well, pickle works. '''
+    bug = _PickleBug()
+    for field in _FIELDS:
+        setattr(bug, field, getattr(bz_bug, field))
+    bug.last_change_time = _change_time(bz_bug)
+    return bug
 
 
-class BzPluginError(Exception):
-    ''' Common base class for exceptions in this plugin. '''
-    pass
+def _bug_key(bug):
+    ''' Return the bug state compared when looking for changed bugs. '''
+    return (bug.status, bug.short_desc, bug.url,
+            len(bug.attachments), len(bug.longdescs), _change_time(bug))
 
 
-class _PickleBug:
-    ''' Simple, non-proxy bug data container. '''
-    pass
+def _diff(oldbugs, bz_bugs, ids=None):
+    """
+    Compare oldbugs, a dict of bugs by id, with bz_bugs. ids lists all
+    bugs in the watch if bz_bugs only holds the changed ones. Returns
+    the new dict of bugs and a list of changes: (None, newbug) for
+    added bugs, (oldbug, newbug) for changed and (oldbug, None) for
+    bugs which have left the watch. Unchanged bugs are kept as-is.
+    """
+    bugs = {}
+    changes = []
+    for bz_bug in bz_bugs:
+        if not bz_bug:
+            continue
+        oldbug = oldbugs.get(bz_bug.id)
+        if oldbug and _bug_key(oldbug) == _bug_key(bz_bug):
+            bugs[oldbug.id] = oldbug
+            continue
+        bug = _copy_bug(bz_bug)
+        bugs[bug.id] = bug
+        changes.append((oldbug, bug))
+    if ids is not None:
+        for id_ in ids:
+            if id_ not in bugs and id_ in oldbugs:
+                bugs[id_] = oldbugs[id_]
+    for id_, oldbug in oldbugs.iteritems():
+        if id_ not in bugs:
+            changes.append((oldbug, None))
+    return bugs, changes
+
+
+def _read_bugs(url, firstbug, query, bz, logger, known, chunk,
+               checkpoint=None):
+    """
+    Read bugs with id >= firstbug from a file:// url, or from bugzilla
+    bz using the parsed query dict. known is a dict of last change
+    times by id, bugs with unchanged time are not read from bugzilla.
+    Changed bugs are read chunk at a time, calling checkpoint() if
+    given before each. Return (ids, bugs): all ids found, None if all
+    are read, and the read bugs, an iterator for file:// urls.
+    """
+    # pylint: disable=R0913
+    if url.startswith('file://'):
+        path = url.replace('file://', '')
+        logger.debug("Taking testdata from: " + path)
+        return None, dataset.iterate(path, firstbug)
+    query = dict(query)
+    query['include_fields'] = ['id', 'last_change_time']
+    query = bz.build_query(**query)     # pylint: disable=W0142
+    try:
+        start = time.time()
+        proxybugs = bz.query(query)
+        if firstbug:
+            proxybugs = [b for b in proxybugs if b.id > firstbug]
+        ids = [b.id for b in proxybugs]
+        changed = [b.id for b in proxybugs
+                       if not _change_time(b)
+                           or known.get(b.id) != _change_time(b)]
+        logger.debug("Bz, found: %d, changed: %d, %s" %
+                     (len(ids), len(changed), str(time.time() - start)))
+        bugs = []
+        for i in range(0, len(changed), chunk):
+            if checkpoint:
+                checkpoint()
+            bugs.extend(bz.getbugs(changed[i:i + chunk]))
+        logger.debug("Bz, loaded: " + str(time.time() - start))
+    except ssl.SSLError as e:
+        raise BzPluginError(str(e))
+    return ids, bugs
+
+
+_worker_bugzillas = {}
+
+
+def _worker_refresh(url, firstbug, query, path, fingerprint, full, chunk):
+    """
+    Run in a worker process: read bugs, compare to and replace the
+    watch state in path, discarding stored bugs if full. Return the
+    changes, see workers.compact(), and the messages to log, see
+    workers.Messages.
+    """
+    # pylint: disable=R0913
+    logger = workers.Messages()
+    if not _is_recorded(url) and url not in _worker_bugzillas:
+        _worker_bugzillas[url] = bugzilla.Bugzilla(url=url)
+    oldbugs = {}
+    if not full:
+        try:
+            oldbugs = dataset.load_state(path)['bugs']
+        except (IOError, ValueError, EOFError):
+            pass
+    ids, bz_bugs = _read_bugs(url, firstbug, query,
+                              _worker_bugzillas.get(url), logger,
+                              _change_times(oldbugs), chunk)
+    bugs, changes = _diff(oldbugs, bz_bugs, ids)
+    try:
+        dataset.dump_state(path, bugs, fingerprint)
+    except IOError:
+        logger.warning("Cannot dump bugs to : " + path)
+    return (workers.compact(changes, _FIELDS + ['last_change_time']),
+            logger.messages)
+
+
+_WORKERS = workers.Workers()
+
+_SHARED = shared.Manager(_PickleBug)
+
+_GATE = gate.Gate()
+
+_PROFILER = profiling.Profiler()
 
 
 class _Watch(object):
     """
     Represents a watch. The watch is a critical zone
     accessed both by main thread and the Fetcher, guarded by the
-    lock attribute.
+    lock attribute. The generation counts changes of the stored bugs,
+    see fetch_state().
     """
+    # pylint: disable=R0902
+
+    log = log.getPluginLogger('bz.watch')
 
     def __init__(self, watchname):
         """
@@ -143,111 +253,257 @@ class _Watch(object):
         from supybot registry.
         """
 
-        self.log = log.getPluginLogger('bz.watch')
         self.name = watchname
         self.lock = threading.Lock()
         self.bugs = None
+        self.fingerprint = None
         self.bugzilla = None
-        url = config.watch_option(watchname, 'url').value
-        if not url.startswith('file://'):
+        self._renderer = None
+        self._replay = None
+        self._shared_seq = None
+        self._generation = 0
+        url = self.settings.url
+        if not _is_recorded(url):
             try:
                 self.bugzilla = bugzilla.Bugzilla(url=url)
             except IOError:
                 self.log.error("Cannot create Bugzilla for " + str(url))
         self._load(url)
 
-    def _get_query(self):
-        ''' Convert querystrings to bz query format, throws ValueError. '''
-        # pylint: disable=E1101
-        dict_ = {}
-        for item in config.watch_option(self.name, 'query').value:
-            key, value = item.split(':', 1)
-            dict_[key] = value
-        dict_['include_fields'] = list(_FIELDS)
-        return self.bugzilla.build_query(**dict_)   # pylint: disable=W0142
+    settings = property(lambda self: config.watch_config(self.name))
+
+    def _get_renderer(self):
+        ''' Return renderer, rebuilt if the watch config is changed. '''
+        settings = self.settings
+        if not self._renderer or self._renderer.settings is not settings:
+            self._renderer = render.Renderer(settings)
+        return self._renderer
+
+    renderer = property(_get_renderer)
+
+    path = property(lambda self: os.path.join('bz.' + self.name + '.pickle'))
 
     def _load(self, url):
-        ''' Load bugs from pickled data on disk '''
-        path = os.path.join('bz.' + self.name + '.pickle')
+        ''' Load bugs and related state from pickled data on disk '''
+        path = self.path
         try:
-            with open(path, 'r') as f:
-                self.bugs = pickle.load(f)
+            state = dataset.load_state(path)
+            self.bugs = state['bugs']
+            self.fingerprint = state['fingerprint']
+            self._shared_seq = state['shared_seq']
             self.log.debug("_load: loaded %d bugs" % len(self.bugs))
-        except (IOError, ValueError):
-            self.bugs = []
+        except (IOError, ValueError, EOFError):
+            self.bugs = {}
             self.log.warning("Cannot load bugs from: " + path,
                               exc_info=True)
             self._dump()
 
     def _dump(self):
-        ''' Dump bugs as pickled data to disk. '''
-        path = os.path.join('bz.' + self.name + '.pickle')
+        ''' Dump bugs and related state as pickled data to disk. '''
+        path = self.path
         try:
-            with open(path, 'w') as f:
-                pickle.dump(self.bugs, f)
+            with _PROFILER.stage(self.name, 'dump'):
+                dataset.dump_state(path, self.bugs, self.fingerprint,
+                                   self._shared_seq)
         except IOError:
             self.log.warning("Cannot dump bugs to : " + path)
 
-    def _read_from_bz(self):
-        ''' Return list of new, loaded bugs from url source. '''
-        url = config.watch_option(self.name, 'url').value
-        firstbug = config.watch_option(self.name, 'firstbug').value
-        if url.startswith('file://'):
-            path = url.replace('file://', '')
-            with open(path, 'r') as f:
-                bugs = pickle.load(f)
-            self.log.debug("Taking testdata from: " + path)
-            if firstbug:
-                bugs = [b for b in bugs if b.id >= firstbug]
-        else:
-            query = self._get_query()
+    def _get_replay(self, settings):
+        ''' Return the replay:// snapshot stream, throws BzPluginError. '''
+        pattern = settings.url.replace('replay://', '')
+        if not self._replay or self._replay.pattern != pattern \
+                or self._replay.period != settings.replayperiod:
             try:
-                # pylint: disable=E1101
-                start = time.time()
-                proxybugs = self.bugzilla.query(query)
-                self.log.debug("Bz, found: " + str(time.time() - start))
-                if firstbug:
-                    proxybugs = [b for b in proxybugs if b.id > firstbug]
-                bugs = self.bugzilla.getbugs([b.id for b in proxybugs])
-                self.log.debug("Bz, loaded: " + str(time.time() - start))
-            except ssl.SSLError as e:
+                self._replay = dataset.Replay(pattern, settings.replayperiod)
+            except ValueError as e:
                 raise BzPluginError(str(e))
-        return bugs
+        self.log.debug("Replaying testdata from: " + pattern)
+        return self._replay
 
-    def _store_bugs(self, bz_bugs):
-        ''' Save bugs as PickleBug so that, well, pickle works. '''
-        bugs = []
-        for bz_bug in bz_bugs:
-            bug = _PickleBug()
-            for field in _FIELDS:
-                setattr(bug, field, getattr(bz_bug, field))
-            bugs.append(bug)
-        self.bugs = bugs
-        self._dump()
+    def _source(self):
+        """
+        Return (url, firstbug, query dict) to read bugs from, replay://
+        urls resolved to current snapshot. Throws ValueError on bad query.
+        """
+        settings = self.settings
+        if settings.url.startswith('file://'):
+            return settings.url, settings.firstbug, None
+        if settings.url.startswith('replay://'):
+            path = self._get_replay(settings).current()
+            return 'file://' + path, settings.firstbug, None
+        return settings.url, settings.firstbug, settings.query_dict()
+
+    def _read_from_bz(self, known):
+        ''' Return (ids, bugs) from url source, see _read_bugs(). '''
+        url, firstbug, query = self._source()
+        with _PROFILER.stage(self.name, 'fetch'):
+            return _read_bugs(url, firstbug, query, self.bugzilla,
+                              self.log, known,
+                              config.global_option('fetchChunk').value)
+
+    def _refresh_in_worker(self, pool, fingerprint, full):
+        ''' Let a worker process do _refresh(), return changes. '''
+        url, firstbug, query = self._source()
+        with _PROFILER.stage(self.name, 'fetch'):
+            events, messages = pool.apply(
+                _worker_refresh,
+                (url, firstbug, query, self.path, fingerprint, full,
+                 config.global_option('fetchChunk').value))
+        for level, message in messages:
+            self.log.log(level, message)
+        if full:
+            self.bugs = {}
+        return workers.expand(self.bugs, events, _PickleBug)
+
+    def _refresh(self, bz_bugs=None, ids=None, full=False):
+        """
+        Store bz_bugs, or bugs read from source if None, dropping bugs
+        not in ids or, if None, in bz_bugs. Stored bugs are replaced
+        without reporting any changes if full or if the query or firstbug
+        is changed since they were fetched. Otherwise, return the changes,
+        see _diff(). Caller holds the lock.
+        """
+        fingerprint = self.settings.fingerprint
+        full = full or self.fingerprint != fingerprint
+        oldbugs = {} if full else self.bugs
+        pool = _WORKERS.get() if bz_bugs is None else None
+        if pool:
+            changes = self._refresh_in_worker(pool, fingerprint, full)
+        else:
+            if bz_bugs is None:
+                ids, bz_bugs = self._read_from_bz(_change_times(oldbugs))
+            with _PROFILER.stage(self.name, 'store'):
+                self.bugs, changes = _diff(oldbugs, bz_bugs, ids)
+        self.fingerprint = fingerprint
+        self._generation += 1
+        self._publish(full, changes)
+        if not pool:
+            self._dump()
+        if full:
+            self.log.info("Reloaded all %d bugs in %s" %
+                          (len(self.bugs), self.name))
+            return []
+        return changes
+
+    def _publish(self, full, changes):
+        """
+        Share changes with other instances if leader, together with a
+        snapshot of all bugs if full or the latest one is getting old.
+        A follower reloaded here resyncs from the latest snapshot.
+        """
+        store = _SHARED.get()
+        if full:
+            self._shared_seq = None
+        if not store:
+            return
+        key = shared.watch_key(self.settings)
+        if not store.lead(key):
+            return
+        if changes and not full:
+            self._shared_seq = store.publish_changes(key, changes)
+        age = store.reload_age(key)
+        if full or age is None or age > shared.SNAPSHOT_PERIOD:
+            self._shared_seq = store.publish_reload(key, self.bugs)
+
+    def follow(self, store):
+        """
+        Apply changes published by the leader instance in store since
+        last call, return them. Initially, and if events have been lost,
+        the bugs are silently replaced by the leader's latest snapshot.
+        Caller must not hold the lock.
+        """
+        with self.lock:
+            settings = self.settings
+            last_seq = store.last_seq()
+            events = store.read(shared.watch_key(settings),
+                                self._shared_seq)
+            if not events:
+                if self._shared_seq is None:
+                    # No snapshot yet, keep own bugs until there is.
+                    self._shared_seq = last_seq
+                return []
+            changes = []
+            for _, kind, data in events:
+                if kind == 'reload':
+                    self.bugs = data
+                    continue
+                for oldbug, newbug in data:
+                    if newbug:
+                        self.bugs[newbug.id] = newbug
+                    else:
+                        self.bugs.pop(oldbug.id, None)
+                changes.extend(data)
+            self._shared_seq = events[-1][0]
+            self.fingerprint = settings.fingerprint
+            self._generation += 1
+            self._dump()
+            return changes
+
+    def fetch_state(self):
+        """
+        Return (generation, last change times by id for stored bugs)
+        when starting a fetch made without holding the lock. The times
+        are used for incremental fetches, empty if a full reload is due.
+        Pass the generation to merge().
+        """
+        with self.lock:
+            if self.fingerprint != self.settings.fingerprint:
+                return self._generation, {}
+            return self._generation, _change_times(self.bugs)
 
     def update(self):
-        ''' Read bugs data from bugzilla. '''
+        ''' Reload all bugs data from bugzilla. '''
         with self.lock:
-            bz_bugs = self._read_from_bz()
-            self._store_bugs(bz_bugs)
+            self._refresh(full=True)
 
-    def poll(self, poll_cb, break_func=lambda: False):
-        """Contact bugzilla and update bugs appropriately. For
-        each changed bug call poll_cb(oldbug, newbug);
-        break this loop if break_func returns True
+    def _fetch(self, checkpoint):
+        """
+        Read changed bugs without holding the lock, calling checkpoint()
+        between chunks, then store them. Return the changes.
         """
+        generation, known = self.fetch_state()
         with self.lock:
-            newbugs = self._read_from_bz()
-            for i in range(0, len(newbugs)):
+            url, firstbug, query = self._source()
+        with _PROFILER.stage(self.name, 'fetch'):
+            ids, bz_bugs = _read_bugs(
+                url, firstbug, query, self.bugzilla, self.log, known,
+                config.global_option('fetchChunk').value, checkpoint)
+        return self.merge(bz_bugs, ids, generation)
+
+    def poll(self, poll_cb, break_func=lambda: False, checkpoint=None):
+        """Contact bugzilla and update bugs appropriately. For
+        each changed bug call poll_cb(oldbug, newbug), newbug is None
+        for bugs leaving the watch; break this loop if break_func
+        returns True. When another instance leads the watch through
+        the sharedStore, apply the changes it has published instead.
+        If checkpoint is given, bugs are read outside the lock, see
+        _fetch(). Not in worker processes, which read all bugs at once.
+        """
+        store = _SHARED.get()
+        if store and not store.lead(shared.watch_key(self.settings)):
+            changes = self.follow(store)
+        elif checkpoint and not _WORKERS.get():
+            changes = self._fetch(checkpoint)
+        else:
+            with self.lock:
+                changes = self._refresh()
+        with _PROFILER.stage(self.name, 'notify'):
+            for oldbug, newbug in changes:
                 if break_func():
                     return
-                if not newbugs[i]:
-                    continue
-                try:
-                    poll_cb(self.bugs[i], newbugs[i], self)
-                except IndexError:
-                    poll_cb(None, newbugs[i], self)
-            self._store_bugs(newbugs)
+                poll_cb(oldbug, newbug, self)
+
+    def merge(self, bz_bugs=None, ids=None, generation=None):
+        """Store bugs fetched elsewhere, or read them now if None.
+        Return the changes, see _refresh(). If generation is given and
+        the bugs are changed since the fetch started (see fetch_state())
+        the fetched bugs are stale: drop them, and return no changes.
+        """
+        with self.lock:
+            if generation is not None and generation != self._generation:
+                self.log.info("Dropping stale fetch for " + self.name)
+                return []
+            return self._refresh(bz_bugs, ids)
 
     @staticmethod
     def create(watchname, url, channels):
@@ -255,6 +511,7 @@ class _Watch(object):
         config.watch_option(watchname, 'url').setValue(url)
         config.watch_option(watchname, 'channels').setValue(channels)
         config.watch_option(watchname, 'firstbug').setValue(0)
+        config.invalidate_watch(watchname)
         return _Watch(watchname)
 
 
@@ -326,14 +583,102 @@ class _Fetcher(threading.Thread):
 
     def run(self):
         start = time.time()
+        with _PROFILER.cycle():
+            for watch in self.watches.get():
+                try:
+                    with _GATE.background():
+                        watch.poll(self._callback,
+                                   lambda: self._shutdown,
+                                   _GATE.checkpoint)
+                except BzPluginError as e:
+                    self.log.warning(
+                        "Cannot poll: %s :%s" % (watch.name, str(e)))
+        self.log.debug("Exiting bz thread, elapsed: " +
+                       str(time.time() - start))
+
+
+class _PooledFetcher(threading.Thread):
+    """
+    Thread polling watches using the pooled fetch engine. Changes are
+    reported by calling fetch_done_cb on the main thread.
+    """
+
+    def __init__(self, watches, fetch_done_cb, engine):
+        self.watches = watches
+        self.log = log.getPluginLogger('bz.fetcher')
+        threading.Thread.__init__(self)
+        self._shutdown = False
+        self._callback = fetch_done_cb
+        self._engine = engine
+
+    def stop(self):
+        ''' Shut down the thread after current fetch. '''
+        self._shutdown = True
+
+    def _report(self, watch, changes):
+        ''' Run the callback for all changes on main thread. '''
+
+        def report():
+            ''' Report all changes, on main thread. '''
+            for oldbug, newbug in changes:
+                self._callback(oldbug, newbug, watch)
+
+        if changes:
+            _Scheduler.run_callback(
+                report, 'bz.report.%s.%f' % (watch.name, time.time()))
+
+    def run(self):
+        start = time.time()
+        with _GATE.background():
+            with _PROFILER.cycle():
+                self._poll(_GATE.checkpoint)
+        self.log.debug("Exiting pooled bz thread, elapsed: " +
+                       str(time.time() - start))
+
+    def _poll(self, checkpoint):
+        """
+        Fetch all watches in one go, calling checkpoint() between chunks,
+        store and report results one watch at a time calling checkpoint()
+        before each. Watches led by
+        another instance through the sharedStore follow it instead.
+        """
+        store = _SHARED.get()
+        watches = []
+        requests = []
         for watch in self.watches.get():
+            settings = watch.settings
+            if store and not store.lead(shared.watch_key(settings)):
+                self._report(watch, watch.follow(store))
+                continue
+            if _is_recorded(settings.url):
+                try:
+                    self._report(watch, watch.merge())
+                except BzPluginError as e:
+                    self.log.warning(
+                        "Cannot poll: %s :%s" % (watch.name, str(e)))
+                continue
+            generation, known = watch.fetch_state()
             try:
-                watch.poll(self._callback, lambda: self._shutdown)
-            except BzPluginError as e:
+                requests.append((settings.url,
+                                 settings.query_dict(),
+                                 settings.firstbug,
+                                 known))
+            except ValueError:
+                self.log.warning("Bad query for: " + watch.name)
+                continue
+            watches.append((watch, generation))
+        with _PROFILER.stage('all', 'fetch'):
+            results = self._engine.fetch_all(requests, checkpoint)
+        for (watch, generation), result in zip(watches, results):
+            if self._shutdown:
+                break
+            checkpoint()
+            if isinstance(result, fetch.FetchError):
                 self.log.warning(
-                    "Cannot poll: %s :%s" % (watch.name, str(e)))
-        self.log.debug("Exiting bz thread, elapsed: " +
-                       str(time.time() - start))
+                    "Cannot poll: %s :%s" % (watch.name, str(result)))
+                continue
+            ids, bugs = result
+            self._report(watch, watch.merge(bugs, ids, generation))
 
 
 class _Scheduler(object):
@@ -347,6 +692,7 @@ class _Scheduler(object):
         self._fetch_done_cb = fetch_done_cb
         self.log = log.getPluginLogger('bz.scheduler')
         self.fetcher = None
+        self._engine = None
         self.reset()
 
     fetching_alive = \
@@ -387,8 +733,25 @@ class _Scheduler(object):
             except Exception, e:
                 self.log.error('Stopping fetcher: %s' % str(e),
                                exc_info=True)
+        if self._engine:
+            self._engine.close()
+            self._engine = None
         self.reset(die = True)
 
+    def _get_engine(self):
+        ''' Return the pooled fetch engine, created on first use. '''
+        args = (config.global_option('fetchConnections').value,
+                config.global_option('fetchTimeout').value,
+                config.global_option('fetchChunk').value)
+        if self._engine and \
+                (self._engine.connections, self._engine.timeout,
+                    self._engine.chunk_size) != args:
+            self._engine.close()
+            self._engine = None
+        if not self._engine:
+            self._engine = fetch.Engine(*args)     # pylint: disable=W0142
+        return self._engine
+
     def start_fetch(self):
         ''' Start next Fetcher run. '''
         if not config.global_option('pollPeriod').value:
@@ -398,7 +761,12 @@ class _Scheduler(object):
             self.fetcher.stop()
             self.fetcher.join()
             self.log.info("Stopped fetcher")
-        self.fetcher = _Fetcher(self.watches, self._fetch_done_cb)
+        if config.global_option('fetchEngine').value == 'pooled':
+            self.fetcher = _PooledFetcher(self.watches,
+                                          self._fetch_done_cb,
+                                          self._get_engine())
+        else:
+            self.fetcher = _Fetcher(self.watches, self._fetch_done_cb)
         self.fetcher.start()
 
     @staticmethod
@@ -422,9 +790,10 @@ class Bz(callbacks.PluginRegexp):
 
         def poll_cb(oldbug, newbug, watch):
             ''' Report diffs in newbug state compared to oldbug. '''
-            _on_bug_change(oldbug, newbug, watch, irc)
+            render.on_bug_change(oldbug, newbug, watch, irc)
 
         callbacks.PluginRegexp.__init__(self, irc)
+        _WORKERS.start()
         self.watches = _Watches()
         self.scheduler = _Scheduler(self.watches, poll_cb)
         if hasattr(irc, 'reply'):
@@ -434,6 +803,8 @@ class Bz(callbacks.PluginRegexp):
     def die(self):
         ''' Stop all threads.  '''
         self.scheduler.stop()
+        _WORKERS.stop()
+        _SHARED.stop()
         callbacks.PluginRegexp.die(self)
 
     def snarf_bug(self, irc, msg, match):
@@ -442,9 +813,9 @@ class Bz(callbacks.PluginRegexp):
         # framework if string matching regexp above is found in chat.
         bugid = int(match.group(1))
         for w in self.watches.get():
-            found = [b for b in w.bugs if b.id == bugid]
-            if found:
-                irc.reply(_snarf_msg(found[0]))
+            bug = w.bugs.get(bugid)
+            if bug:
+                irc.reply(w.renderer.snarf.render(bug))
                 return
 
     def watchadd(self, irc, msg, args, name, url, channels):
@@ -475,8 +846,10 @@ class Bz(callbacks.PluginRegexp):
             irc.reply("Error: no such watch.")
             return
         config.watch_option(name, 'query').setValue(query.split())
+        config.invalidate_watch(name)
         try:
-            watch.update()
+            with _GATE.interactive():
+                watch.update()
         except BzPluginError as e:
             irc.reply("Error: Can't read bug data: " + str(e))
         else:
@@ -521,11 +894,10 @@ class Bz(callbacks.PluginRegexp):
         if not w:
             irc.reply("Error: no such watch.")
             return
-        url = config.watch_option(w.name, 'url').value
-        query = config.watch_option(watchname, 'query').value
-        channels = config.watch_option(watchname, 'channels').value
+        settings = w.settings
         irc.reply("url: %s, channels: %s, query: %s"
-                   % (url, ','.join(channels), query))
+                   % (settings.url, ','.join(settings.channels),
+                      settings.query))
 
     watchconf = wrap(watchconf, ['owner', 'somethingWithoutSpaces'])
 
@@ -537,7 +909,7 @@ class Bz(callbacks.PluginRegexp):
 
         def watch_cb(oldbug, newbug, watch):
             ''' Report if newbug is changed compared to oldbug. '''
-            _on_bug_change(oldbug, newbug, watch, irc)
+            render.on_bug_change(oldbug, newbug, watch, irc)
 
         if watchname:
             watch = self.watches.get_by_name(watchname)
@@ -547,15 +919,63 @@ class Bz(callbacks.PluginRegexp):
             watches = [watch]
         else:
             watches = self.watches.get()
-        for w in watches:
-            try:
-                w.poll(watch_cb)
-            except BzPluginError as e:
-                irc.reply("Error updating " + w.name + ': ' + str(e))
+        with _GATE.interactive():
+            with _PROFILER.cycle():
+                for w in watches:
+                    try:
+                        w.poll(watch_cb)
+                    except BzPluginError as e:
+                        irc.reply("Error updating " + w.name + ': ' + str(e))
         irc.reply("Polled " + nItems(len(watches), "watch") + '.')
 
     watchpoll = wrap(watchpoll, ['owner', optional('somethingWithoutSpaces')])
 
+    def watchstats(self, irc, msg, args):
+        """ Takes no arguments
+
+        Display time spent waiting for bugzilla by interactive commands
+        and background polls, and how often polls yielded to commands.
+        """
+        stats = _GATE.stats()
+        lanes = []
+        for lane in gate.Gate.LANES:
+            count, average, max_ = stats[lane]
+            lanes.append("%s: %s, wait avg %.3fs max %.3fs" %
+                         (lane, nItems(count, 'request'), average, max_))
+        irc.reply('; '.join(lanes) + "; polls yielded %s." %
+                  nItems(_GATE.yields, 'time'))
+
+    watchstats = wrap(watchstats, ['owner'])
+
+    def watchprofile(self, irc, msg, args, cycles, top):
+        """ <cycles> [top]
+
+        Profile the next poll cycles, including watchpoll. Afterwards,
+        write bz.<watch>.<stage>.prof files and report the top functions
+        for each stage, by default 5.
+        """
+        log_ = self.log
+
+        def report(stats):
+            ''' Save profiles, send summary to where we were asked. '''
+            target = ircutils.replyTo(msg)
+            if not stats:
+                irc.queueMsg(ircmsgs.privmsg(target, "No profile data."))
+            for (watch, stage), stats_ in sorted(stats.iteritems()):
+                path = 'bz.%s.%s.prof' % (watch, stage)
+                try:
+                    stats_.dump_stats(path)
+                except IOError:
+                    log_.warning("Cannot dump profile to: " + path)
+                irc.queueMsg(ircmsgs.privmsg(
+                    target, path + ': ' + profiling.summary(stats_, top)))
+
+        _PROFILER.start(cycles, report)
+        irc.reply("Profiling next %s." % nItems(cycles, 'poll cycle'))
+
+    watchprofile = wrap(watchprofile,
+                        ['owner', 'positiveInt', optional('positiveInt', 5)])
+
     def watchhelp(self, irc, msg, args):
         """ Takes no arguments
 
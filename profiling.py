@@ -0,0 +1,130 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+On demand profiling of poll cycles, see the watchprofile command.
+
+The poll code marks its stages (fetch, store, dump, notify) using
+Profiler.stage(). This is a no-op unless the running thread is inside
+a profiled cycle i. e., Profiler.cycle() after Profiler.start(), so it
+can stay in place permanently. Each profiled cycle records one
+cProfile profile per watch and stage. The profiles are merged across
+cycles and handed to a callback after the last one.
+"""
+
+import contextlib
+import cProfile
+import os.path
+import pstats
+import threading
+
+
+class Profiler(object):
+    ''' Collects cProfile stats by watch and stage for a number of cycles. '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cycles = 0
+        self._stats = {}
+        self._done_cb = None
+
+    def start(self, cycles, done_cb):
+        """
+        Profile the next cycles cycles, then call done_cb(stats) where
+        stats is a dict of pstats.Stats by (watch, stage).
+        """
+        with self._lock:
+            self._cycles = cycles
+            self._stats = {}
+            self._done_cb = done_cb
+
+    @contextlib.contextmanager
+    def cycle(self):
+        ''' Run a poll cycle, profiled if started. '''
+        if not self._cycles:
+            yield
+        else:
+            profiles = {}
+            self._local.profiles = profiles
+            try:
+                yield
+            finally:
+                self._local.profiles = None
+                self._finish(profiles)
+
+    def _finish(self, profiles):
+        ''' Merge profiles from a completed cycle, report if last. '''
+        with self._lock:
+            if not self._cycles:
+                return
+            for key, profile in profiles.iteritems():
+                stats = pstats.Stats(profile)
+                if key in self._stats:
+                    self._stats[key].add(stats)
+                else:
+                    self._stats[key] = stats
+            self._cycles -= 1
+            if self._cycles:
+                return
+            stats, done_cb = self._stats, self._done_cb
+            self._stats, self._done_cb = {}, None
+        done_cb(stats)
+
+    @contextlib.contextmanager
+    def stage(self, watch, name):
+        ''' Run a stage of the poll for watch, profiled if in a cycle. '''
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            yield
+        else:
+            key = (watch, name)
+            if key not in profiles:
+                profiles[key] = cProfile.Profile()
+            profiles[key].enable()
+            try:
+                yield
+            finally:
+                profiles[key].disable()
+
+
+def summary(stats, top):
+    """
+    Return a one-line summary of pstats.Stats stats: total time and
+    the top functions by internal time.
+    """
+    hot = sorted(stats.stats.iteritems(), key=lambda item: -item[1][2])
+    hot = ['%s (%s:%d) %.3fs' % (func[2], os.path.basename(func[0]),
+                                 func[1], value[2])
+               for func, value in hot[:top]]
+    return '%.3fs in %d calls, top: %s' % \
+        (stats.total_tt, stats.total_calls, ', '.join(hot))
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
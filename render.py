@@ -0,0 +1,132 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+""" Notifications about changed bugs, rendered from message templates. """
+
+import re
+
+from supybot import ircmsgs
+
+
+# Fields available in message templates, as $name or ${name}.
+_TEMPLATE_FIELDS = {
+    'id': lambda bug: bug.id,
+    'short_desc': lambda bug: bug.short_desc,
+    'status': lambda bug: bug.status,
+    'url': lambda bug: bug.url,
+    'author':
+        lambda bug: bug.longdescs[-1]['author'] if bug.longdescs else '',
+    'attachments': lambda bug: len(bug.attachments),
+    'comments': lambda bug: len(bug.longdescs),
+}
+
+_TEMPLATE_RE = re.compile(r'\$(?:(\w+)|\{(\w+)\}|(\$))')
+
+
+class _Template(object):
+    """
+    A message template like 'Bug $id: $short_desc', compiled once to
+    a plain format string and a list of field getters. Unknown fields
+    are left as-is, '$$' is a literal '$'.
+    """
+
+    def __init__(self, text):
+        self._getters = []
+
+        def compile_field(match):
+            ''' Replace a $field reference with a %s placeholder. '''
+            if match.group(3):
+                return '$'
+            name = match.group(1) or match.group(2)
+            if name not in _TEMPLATE_FIELDS:
+                return match.group(0)
+            self._getters.append(_TEMPLATE_FIELDS[name])
+            return '%s'
+
+        self._format = \
+            _TEMPLATE_RE.sub(compile_field, text.replace('%', '%%'))
+
+    def render(self, bug):
+        ''' Return the message for given bug. '''
+        return self._format % tuple([get(bug) for get in self._getters])
+
+
+_TEMPLATES = {}
+
+
+def _get_template(text):
+    ''' Return a compiled template, cached on the template text. '''
+    if text not in _TEMPLATES:
+        _TEMPLATES[text] = _Template(text)
+    return _TEMPLATES[text]
+
+
+class Renderer(object):
+    """
+    Renders notifications for a watch. The watch configuration
+    (channels, templates) is resolved once when created. Each message
+    is rendered once and then sent to all channels.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.channels = settings.channels
+        self.new_bug = _get_template(settings.newbugformat)
+        self.status_change = _get_template(settings.statusformat)
+        self.commented = _get_template(settings.commentformat)
+        self.snarf = _get_template(settings.snarfformat)
+        self.removed = None
+        if settings.reportremoved:
+            self.removed = _get_template(settings.removedformat)
+
+    def send(self, text, irc):
+        ''' Send text as a notice to all channels. '''
+        for channel in self.channels:
+            irc.queueMsg(ircmsgs.notice(channel, text))
+
+
+def on_bug_change(oldbug, newbug, watch, irc):
+    ''' Report diffs in newbug state compared to oldbug. '''
+    renderer = watch.renderer
+    if not newbug:
+        if renderer.removed:
+            renderer.send(renderer.removed.render(oldbug), irc)
+        return
+    if not oldbug:
+        template = renderer.new_bug
+    elif oldbug.status != newbug.status:
+        template = renderer.status_change
+    elif len(oldbug.longdescs) != len(newbug.longdescs):
+        template = renderer.commented
+    else:
+        return
+    renderer.send(template.render(newbug), irc)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,268 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Coordination of several bot instances on one host watching the same
+bugs, see the sharedStore option.
+
+The instances share a SQLite file. Each watch, identified by
+watch_key(), has its own leader: the instance holding an exclusive
+lock on <file>.<sha1 of key>.lock. It polls bugzilla and publishes
+the changes found as events in the file, together with a periodic
+'reload' snapshot of all bugs. The other instances read these events
+instead of polling bugzilla, starting from the latest snapshot. If the
+leader exits the lock is released, and another instance takes over on
+its next poll. A watch no other instance has is polled as usual.
+
+Events are stored as JSON, not pickles: the file might be writable by
+other users, and unpickling it would let them run code in the bot.
+"""
+
+import fcntl
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import config
+
+# Events older than this (seconds) are removed when publishing, unless
+# needed after the latest snapshot.
+KEEP_EVENTS = 24 * 3600
+
+# The leader publishes a new snapshot when the latest is this old.
+SNAPSHOT_PERIOD = KEEP_EVENTS / 2
+
+_PRUNABLE = "created < ? AND seq < (SELECT max(r.seq) FROM events AS r" \
+            " WHERE r.watch = events.watch AND r.kind = 'reload')"
+
+
+def watch_key(settings):
+    ''' Return the key identifying a watch's events given its config. '''
+    return '%s %s' % (settings.url, settings.fingerprint)
+
+
+def _encode(data):
+    ''' Return data as JSON, values not known by JSON as strings. '''
+    return json.dumps(data, default=str)
+
+
+class Store(object):
+    """
+    Change events for all watches, shared through a SQLite file. Bugs
+    are read back as bug_class instances.
+    """
+
+    def __init__(self, path, bug_class):
+        self.path = path
+        self._bug_class = bug_class
+        self._lock = threading.Lock()
+        self._lockfiles = {}
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                         ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                         ' watch TEXT NOT NULL,'
+                         ' created REAL NOT NULL,'
+                         ' kind TEXT NOT NULL,'
+                         ' data TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS events_watch'
+                         ' ON events (watch, seq)')
+            conn.execute('CREATE TABLE IF NOT EXISTS pruned ('
+                         ' watch TEXT PRIMARY KEY,'
+                         ' seq INTEGER NOT NULL)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        ''' Return a new connection, these can't be shared by threads. '''
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _bug(self, fields):
+        ''' Return a bug_class instance given its fields, or None. '''
+        if fields is None:
+            return None
+        bug = self._bug_class()
+        for field, value in fields.iteritems():
+            setattr(bug, str(field), value)
+        return bug
+
+    def lead(self, key):
+        """
+        Try to become leader for watch key unless already, return True
+        if leader.
+        """
+        with self._lock:
+            if key in self._lockfiles:
+                return True
+            path = '%s.%s.lock' % (self.path, hashlib.sha1(key).hexdigest())
+            lockfile = open(path, 'a')
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lockfile.close()
+                return False
+            self._lockfiles[key] = lockfile
+            return True
+
+    def _publish(self, key, kind, data):
+        """
+        Add an event for watch key, return its sequence number. Remove
+        old events, recording the last one removed for each watch.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            seq = conn.execute(
+                'INSERT INTO events (watch, created, kind, data)'
+                ' VALUES (?, ?, ?, ?)',
+                (key, now, kind, _encode(data))).lastrowid
+            cutoff = (now - KEEP_EVENTS,)
+            conn.execute('INSERT OR REPLACE INTO pruned (watch, seq)'
+                         ' SELECT watch, max(seq) FROM events'
+                         ' WHERE ' + _PRUNABLE + ' GROUP BY watch', cutoff)
+            conn.execute('DELETE FROM events WHERE ' + _PRUNABLE, cutoff)
+            conn.commit()
+            return seq
+        finally:
+            conn.close()
+
+    def publish_changes(self, key, changes):
+        ''' Add a list of (oldbug, newbug) changes, return the seq. '''
+        return self._publish(key, 'changes',
+                             [(old and old.__dict__, new and new.__dict__)
+                              for old, new in changes])
+
+    def publish_reload(self, key, bugs):
+        ''' Add a snapshot of the dict of all bugs, return the seq. '''
+        return self._publish(key, 'reload',
+                             [bug.__dict__ for bug in bugs.itervalues()])
+
+    def reload_age(self, key):
+        ''' Return age of latest snapshot for watch key, None if none. '''
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT max(created) FROM events"
+                               " WHERE watch = ? AND kind = 'reload'",
+                               (key,)).fetchone()
+        finally:
+            conn.close()
+        return time.time() - row[0] if row[0] is not None else None
+
+    def last_seq(self):
+        ''' Return sequence number of the last event, 0 if none. '''
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT max(seq) FROM events').fetchone()
+            return row[0] or 0
+        finally:
+            conn.close()
+
+    def _resync_seq(self, conn, key, since):
+        """
+        Return since, or the seq before the latest snapshot for watch key
+        if since is None or events after it are removed. None if there
+        is no such snapshot.
+        """
+        if since is not None:
+            row = conn.execute('SELECT seq FROM pruned WHERE watch = ?',
+                               (key,)).fetchone()
+            if not row or row[0] <= since:
+                return since
+        row = conn.execute("SELECT max(seq) FROM events"
+                           " WHERE watch = ? AND kind = 'reload'",
+                           (key,)).fetchone()
+        return row[0] - 1 if row[0] is not None else None
+
+    def read(self, key, since):
+        """
+        Return list of (seq, kind, data) for watch key after since, data
+        is a list of (oldbug, newbug) changes or, for 'reload', a dict
+        of all bugs by id. If since is None or events after it have been
+        removed, start at the latest snapshot; empty if there is none.
+        """
+        conn = self._connect()
+        try:
+            since = self._resync_seq(conn, key, since)
+            if since is None:
+                return []
+            rows = conn.execute('SELECT seq, kind, data FROM events'
+                                ' WHERE watch = ? AND seq > ?'
+                                ' ORDER BY seq', (key, since)).fetchall()
+        finally:
+            conn.close()
+        events = []
+        for seq, kind, data in rows:
+            data = json.loads(data)
+            if kind == 'reload':
+                bugs = [self._bug(fields) for fields in data]
+                data = dict([(bug.id, bug) for bug in bugs])
+            else:
+                data = [(self._bug(old), self._bug(new)) for old, new in data]
+            events.append((seq, kind, data))
+        return events
+
+    def close(self):
+        ''' Give up leadership of all watches, if any. '''
+        with self._lock:
+            for lockfile in self._lockfiles.values():
+                lockfile.close()
+            self._lockfiles = {}
+
+
+class Manager(object):
+    ''' The Store configured by the sharedStore option, if any. '''
+
+    def __init__(self, bug_class):
+        self._bug_class = bug_class
+        self._lock = threading.Lock()
+        self._store = None
+
+    def get(self):
+        ''' Return the store, or None if not enabled. '''
+        path = config.global_option('sharedStore').value
+        with self._lock:
+            if self._store and path != self._store.path:
+                self._store.close()
+                self._store = None
+            if path and not self._store:
+                self._store = Store(path, self._bug_class)
+            return self._store
+
+    def stop(self):
+        ''' Close the store, letting another instance lead. '''
+        with self._lock:
+            if self._store:
+                self._store.close()
+                self._store = None
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -38,10 +38,30 @@
 
 from supybot.test import *
 from supybot import conf
+from supybot import registry
 
+import BaseHTTPServer
+import glob
+import logging
 import os
 import shutil
+import SimpleXMLRPCServer
+import SocketServer
+import threading
 import time
+import xmlrpclib
+import zlib
+
+from supybot import schedule
+
+import config
+import dataset
+import fetch
+import gate
+import plugin
+import render
+import shared
+import workers
 
 # are not getting responses, you may need to bump this higher.
 LOOP_TIMEOUT = 1.0
@@ -77,6 +97,135 @@ class PluginTestCaseUtilMixin(object):
         return responses
 
 
+class _Handler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/xmlrpc.cgi',)
+
+
+class _Server(SocketServer.ThreadingMixIn,
+              SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class _MalformedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Answers all requests with a broken XML-RPC response."
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = "<?xml version='1.0'?>\n<methodResponse><params><param>" \
+               "<value></param></params></methodResponse>"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _fake_change_time(bug):
+    "A last_change_time which changes when the bug does."
+    stamp = zlib.crc32(repr((bug.status, bug.short_desc,
+                             len(bug.longdescs), len(bug.attachments))))
+    return xmlrpclib.DateTime(time.gmtime(1300000000 + stamp % 100000000))
+
+
+class FakeBugzilla(object):
+    """
+    A local bugzilla serving the bugs in a testdata snapshot, both as
+    python-bugzilla reads them (Bug.get_bugs) and as the pooled fetch
+    engine does (Bug.get, Bug.comments, Bug.attachments). Ids of all
+    bugs read are saved in requested.
+    """
+
+    def __init__(self, path):
+        self.bugs = dataset.load(path)
+        self.requested = []
+        self.delay = 0
+        self.server = _Server(('127.0.0.1', 0), requestHandler=_Handler,
+                              logRequests=False, allow_none=True)
+        self.server.register_function(lambda: {'version': '4.2.1'},
+                                      'Bugzilla.version')
+        for name in ['search', 'get_bugs', 'get', 'comments', 'attachments']:
+            self.server.register_function(getattr(self, name), 'Bug.' + name)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    url = property(lambda self: 'http://127.0.0.1:%d/xmlrpc.cgi' %
+                       self.server.server_address[1])
+
+    def load(self, path):
+        self.bugs = dataset.load(path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, ids):
+        self.requested.extend(ids)
+        return [b for b in self.bugs if b.id in ids]
+
+    def search(self, query):
+        time.sleep(self.delay)
+        return {'bugs': [{'id': b.id,
+                          'last_change_time': _fake_change_time(b)}
+                         for b in self.bugs]}
+
+    def get_bugs(self, params):
+        return {'bugs': [{'id': b.id,
+                          'status': b.status,
+                          'short_desc': b.short_desc,
+                          'longdescs': b.longdescs,
+                          'attachments': b.attachments,
+                          'last_change_time': _fake_change_time(b)}
+                         for b in self._get(params['ids'])]}
+
+    def get(self, params):
+        return {'bugs': [{'id': b.id,
+                          'status': b.status,
+                          'summary': b.short_desc,
+                          'last_change_time': _fake_change_time(b)}
+                         for b in self._get(params['ids'])]}
+
+    def comments(self, params):
+        bugs = dict([(b.id, b) for b in self.bugs])
+        return {'bugs': dict([(str(id_),
+                               {'comments': [{'creator': c['author'],
+                                              'text': c['body']}
+                                             for c in bugs[id_].longdescs]})
+                              for id_ in params['ids']])}
+
+    def attachments(self, params):
+        bugs = dict([(b.id, b) for b in self.bugs])
+        return {'bugs': dict([(str(id_), bugs[id_].attachments)
+                              for id_ in params['ids']])}
+
+
+class _WatchList(object):
+    "Stands in for the plugin's watch list."
+
+    def __init__(self, watches):
+        self.watches = watches
+
+    def get(self):
+        return list(self.watches)
+
+
+class _NoticeCollector(object):
+    "Stands in for an irc, saving the text of all queued messages."
+
+    def __init__(self):
+        self.texts = []
+
+    def queueMsg(self, msg):
+        self.texts.append(msg.args[1])
+
+
 class BzReloadTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#test'
     plugins = ('Bz', 'User', 'Config')
@@ -113,6 +262,17 @@ class BzListTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
             os.unlink('bz.test1.pickle')
         if os.path.exists('bz.test2.pickle'):
             os.unlink('bz.test2.pickle')
+        if os.path.exists('bz.fake.pickle'):
+            os.unlink('bz.fake.pickle')
+        if os.path.exists('bz.test1.d'):
+            shutil.rmtree('bz.test1.d')
+        for path in glob.glob('bz.shared.db*'):
+            os.unlink(path)
+        for watch in ['test1', 'test2', 'fake']:
+            try:
+                conf.supybot.plugins.Bz.watches.unregister(watch)
+            except registry.NonExistentRegistryEntry:
+                pass
         conf.supybot.plugins.Bz.pollPeriod.setValue(0)
         conf.supybot.plugins.Bz.watchlist.setValue([])
         expected = ['Bz reinitialized with 0 watches.',
@@ -170,6 +330,299 @@ class BzListTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponse("watchpoll test1",
                             "Polled 1 watch.")
 
+    def testPollWorkerProcess(self):
+        conf.supybot.plugins.Bz.workerProcesses.setValue(1)
+        try:
+            self.assertResponses('reload Bz',
+                                 ['Bz reinitialized with 2 watches.',
+                                  'The operation succeeded.'])
+            self.assertResponse(
+                "watchquery test1 product:Fedora component:foo",
+                "Watching 28 bugs.")
+            self.assertResponse(
+                "config plugins.bz.watches.test1.url" +
+                    " file://plugins/Bz/testdata/bz.test1.pickle.1",
+                "The operation succeeded.")
+            expected = [
+                "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                    " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+                "Polled 1 watch."
+            ]
+            self.assertResponses("watchpoll test1", expected)
+            self.assertResponse("watchpoll test1",
+                                "Polled 1 watch.")
+        finally:
+            conf.supybot.plugins.Bz.workerProcesses.setValue(0)
+
+    def testWorkerMessages(self):
+        events, messages = plugin._worker_refresh(
+            'file://plugins/Bz/testdata/bz.test1.pickle.0', 0, None,
+            'nosuchdir/bz.test1.pickle', 'fingerprint', True, 5)
+        self.assertEqual(len(events), 28)
+        self.assertTrue(
+            (logging.WARNING,
+             'Cannot dump bugs to : nosuchdir/bz.test1.pickle') in messages)
+
+    def testCompactEvents(self):
+        oldbugs = dict([(b.id, b) for b in dataset.load(
+                           'plugins/Bz/testdata/bz.test1.pickle.0')])
+        newbugs = dataset.load('plugins/Bz/testdata/bz.test1.pickle.1')
+        bugs, changes = plugin._diff(oldbugs, newbugs)
+        self.assertTrue(changes)
+        events = workers.compact(changes,
+                                 plugin._FIELDS + ['last_change_time'])
+        for id_, fields in events:
+            self.assertTrue('id' not in fields or id_ not in oldbugs)
+        expanded = dict(oldbugs)
+        self.assertEqual(
+            [(o and o.id, n and n.id) for o, n in changes],
+            [(o and o.id, n and n.id)
+                for o, n in workers.expand(expanded, events,
+                                           plugin._PickleBug)])
+        self.assertEqual(
+            sorted([plugin._bug_key(b) for b in bugs.values()]),
+            sorted([plugin._bug_key(b) for b in expanded.values()]))
+        self.assertEqual(
+            [b.longdescs for b in sorted(bugs.values(), key=lambda b: b.id)],
+            [b.longdescs for b in sorted(expanded.values(),
+                                         key=lambda b: b.id)])
+
+    def testWatchStats(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse("watchpoll test1", "Polled 1 watch.")
+        self.assertRegexp("watchstats",
+                          r"^interactive: \d+ requests, wait avg [\d.]+s"
+                          r" max [\d.]+s; background: \d+ requests?,"
+                          r" wait avg [\d.]+s max [\d.]+s;"
+                          r" polls yielded \d+ times?\.$")
+
+    def _waitFor(self, predicate):
+        ''' Wait until predicate() is True. '''
+        start = time.time()
+        while not predicate():
+            self.assertTrue(time.time() - start < 5, "Timeout")
+            time.sleep(0.01)
+
+    def testGateOrder(self):
+        gate_ = gate.Gate()
+        order = []
+        blocked = threading.Event()
+        unblock = threading.Event()
+
+        def background():
+            with gate_.background():
+                order.append('background 1')
+                blocked.set()
+                unblock.wait()
+                gate_.checkpoint()
+                order.append('background 2')
+                gate_.checkpoint()
+                order.append('background 3')
+
+        def interactive(name):
+            with gate_.interactive():
+                order.append(name)
+
+        # A background poll yields to a waiting command at checkpoints.
+        threads = [threading.Thread(target=background)]
+        threads[0].start()
+        blocked.wait(5)
+        threads.append(threading.Thread(target=interactive,
+                                        args=('interactive',)))
+        threads[1].start()
+        self._waitFor(lambda: gate_._waiting['interactive'] == 1)
+        unblock.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['background 1', 'interactive',
+                                 'background 2', 'background 3'])
+        self.assertEqual(gate_.yields, 1)
+
+        # Queued commands go ahead of queued polls.
+        order = []
+        blocked.clear()
+        unblock.clear()
+
+        def blocking():
+            with gate_.interactive():
+                blocked.set()
+                unblock.wait()
+
+        threads = [threading.Thread(target=blocking)]
+        threads[0].start()
+        blocked.wait(5)
+        threads.append(threading.Thread(target=background))
+        threads[1].start()
+        self._waitFor(lambda: gate_._waiting['background'] == 1)
+        threads.append(threading.Thread(target=interactive,
+                                        args=('interactive',)))
+        threads[2].start()
+        self._waitFor(lambda: gate_._waiting['interactive'] == 1)
+        unblock.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['interactive', 'background 1',
+                                 'background 2', 'background 3'])
+        stats = gate_.stats()
+        self.assertEqual(stats['interactive'][0], 3)
+        self.assertEqual(stats['background'][0], 3)
+
+    def testWatchProfile(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse("watchprofile 1 2",
+                            "Profiling next 1 poll cycle.")
+        responses = self._feedMsgLoop("watchpoll test1")
+        responses = sorted([m.args[1] for m in responses])
+        self.assertEqual(responses[0], "Polled 1 watch.")
+        stages = ['dump', 'fetch', 'notify', 'store']
+        for stage, response in zip(stages, responses[1:]):
+            path = 'bz.test1.%s.prof' % stage
+            self.assertTrue(response.startswith(path + ': '))
+            self.assertTrue(os.path.exists(path))
+            os.unlink(path)
+        self.assertEqual(len(responses), 5)
+        self.assertResponse("watchpoll test1", "Polled 1 watch.")
+
+    def _addFakeWatch(self, server):
+        self.assertResponse("watchadd fake %s #test" % server.url,
+                            "The operation succeeded.")
+        self.assertResponse("watchquery fake product:Fedora component:foo",
+                            "Watching 28 bugs.")
+
+    def testPooledEngine(self):
+        server = FakeBugzilla('plugins/Bz/testdata/bz.test1.pickle.0')
+        engine = fetch.Engine(2, 10, 5)
+        try:
+            self._addFakeWatch(server)
+            server.load('plugins/Bz/testdata/bz.test1.pickle.1')
+            threaded = [m.args[1] for m in self._feedMsgLoop("watchpoll fake")]
+            self.assertTrue("Polled 1 watch." in threaded)
+            threaded.remove("Polled 1 watch.")
+            self.assertTrue(threaded)
+
+            server.load('plugins/Bz/testdata/bz.test1.pickle.0')
+            self.assertResponse("watchquery fake product:Fedora component:foo",
+                                "Watching 28 bugs.")
+            server.load('plugins/Bz/testdata/bz.test1.pickle.1')
+            watch = self.irc.getCallback('Bz').watches.get_by_name('fake')
+            irc = _NoticeCollector()
+            fetcher = plugin._PooledFetcher(
+                _WatchList([watch]),
+                lambda old, new, w: render.on_bug_change(old, new, w, irc),
+                engine)
+            fetcher.run()
+            schedule.run()
+            self.assertEqual(sorted(irc.texts), sorted(threaded))
+            self.assertEqual(
+                sorted([plugin._bug_key(b) for b in watch.bugs.values()]),
+                sorted([plugin._bug_key(b) for b in
+                        fetch.Engine(1, 10, 5).fetch_all(
+                            [(server.url, {}, 0, {})])[0][1]]))
+        finally:
+            engine.close()
+            server.stop()
+
+    def testPooledEngineCheckpoints(self):
+        server = FakeBugzilla('plugins/Bz/testdata/bz.test1.pickle.0')
+        server.delay = 1
+        engine = fetch.Engine(2, 10, 5)
+        gate_ = gate.Gate()
+        order = []
+        results = []
+
+        def checkpoint():
+            order.append('checkpoint')
+            gate_.checkpoint()
+
+        def background():
+            with gate_.background():
+                results.extend(engine.fetch_all([(server.url, {}, 0, {})],
+                                                checkpoint))
+                order.append('fetched')
+
+        def interactive():
+            with gate_.interactive():
+                order.append('interactive')
+
+        try:
+            threads = [threading.Thread(target=background),
+                       threading.Thread(target=interactive)]
+            threads[0].start()
+            self._waitFor(lambda: order)
+            threads[1].start()
+            for thread in threads:
+                thread.join(10)
+            ids, bugs = results[0]
+            self.assertEqual(len(bugs), 28)
+            # Before the search and each chunk of 5 bugs.
+            self.assertEqual(order.count('checkpoint'), 7)
+            self.assertTrue(
+                order.index('interactive') < order.index('fetched'))
+            self.assertEqual(gate_.yields, 1)
+        finally:
+            engine.close()
+            server.stop()
+
+    def testPooledEngineErrors(self):
+        server = FakeBugzilla('plugins/Bz/testdata/bz.test1.pickle.0')
+        server.delay = 2
+        engine = fetch.Engine(1, 1, 5)
+        try:
+            results = engine.fetch_all([(server.url, {}, 0, {}),
+                                        ('http://127.0.0.1:1/xmlrpc.cgi',
+                                         {}, 0, {})])
+            self.assertTrue(isinstance(results[0], fetch.FetchError))
+            self.assertTrue('timed out' in str(results[0]))
+            self.assertTrue(isinstance(results[1], fetch.FetchError))
+            server.delay = 0
+            ids, bugs = engine.fetch_all([(server.url, {}, 0, {})])[0]
+            self.assertEqual(len(ids), 28)
+            self.assertEqual(len(bugs), 28)
+        finally:
+            engine.close()
+            server.stop()
+
+    def testPooledEngineMalformed(self):
+        server = _HTTPServer(('127.0.0.1', 0), _MalformedHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        url = 'http://127.0.0.1:%d/xmlrpc.cgi' % server.server_address[1]
+        engine = fetch.Engine(1, 5, 200)
+        try:
+            # Twice: the single connection thread must survive.
+            for dummy in range(0, 2):
+                start = time.time()
+                result = engine.fetch_all([(url, {}, 0, {})])[0]
+                self.assertTrue(isinstance(result, fetch.FetchError))
+                self.assertTrue('Bug.search' in str(result))
+                self.assertTrue(time.time() - start < 5)
+        finally:
+            engine.close()
+            server.shutdown()
+            server.server_close()
+        call = fetch._Call('Bug.search', {}, time.time() + 0.1)
+        self.assertRaises(fetch.FetchError, call.result)
+
+    def testPollStatusFormat(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url" +
+                " file://plugins/Bz/testdata/bz.test1.pickle.1",
+            "The operation succeeded.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.statusformat" +
+                " Bug $id is now $status (100% sure)",
+            "The operation succeeded.")
+        expected = [
+            "Bug 768769 is now OPEN (100% sure)",
+            "Polled 1 watch."
+        ]
+        self.assertResponses("watchpoll test1", expected)
+
     def testPollCommentChange(self):
         self.assertResponse("watchquery test1 product:Fedora component:foo",
                             "Watching 28 bugs.")
@@ -190,6 +643,318 @@ class BzListTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponse("watchpoll test1",
                             "Polled 1 watch.")
 
+    def testShardedFirstbug(self):
+        bugs = dataset.load('plugins/Bz/testdata/bz.test1.pickle.0')
+        dataset.write(bugs, 'bz.test1.d', 5)
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url file://bz.test1.d",
+            "The operation succeeded.")
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.firstbug 848283",
+            "The operation succeeded.")
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 12 bugs.")
+
+    def testReplaySavedState(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test2.url file://bz.test1.pickle",
+            "The operation succeeded.")
+        self.assertResponse("watchquery test2 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        dataset.write(dataset.load('bz.test1.pickle'), 'bz.test1.d', 10)
+        self.assertEqual(len(dataset.Dataset('bz.test1.d')), 28)
+
+    def testReplay(self):
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url" +
+                " replay://plugins/Bz/testdata/bz.test1.pickle.*",
+            "The operation succeeded.")
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        expected = [
+            "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+            "Polled 1 watch."
+        ]
+        self.assertResponses("watchpoll test1", expected)
+
+    def _sharedBug(self, snapshot):
+        ''' Return bug 768769 from testdata snapshot. '''
+        return [b for b in dataset.load(
+                    'plugins/Bz/testdata/bz.test1.pickle.' + snapshot)
+                    if b.id == 768769][0]
+
+    def testSharedFollower(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        key = shared.watch_key(config.watch_config('test1'))
+        leader = shared.Store('bz.shared.db', plugin._PickleBug)
+        self.assertTrue(leader.lead(key))
+        conf.supybot.plugins.Bz.sharedStore.setValue('bz.shared.db')
+        try:
+            self.assertResponse("watchpoll test1", "Polled 1 watch.")
+            leader.publish_changes(
+                key, [(self._sharedBug('0'), self._sharedBug('1'))])
+            expected = [
+                "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                    " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+                "Polled 1 watch."
+            ]
+            self.assertResponses("watchpoll test1", expected)
+        finally:
+            conf.supybot.plugins.Bz.sharedStore.setValue('')
+            leader.close()
+
+    def testSharedLeader(self):
+        conf.supybot.plugins.Bz.sharedStore.setValue('bz.shared.db')
+        try:
+            self.assertResponse(
+                "watchquery test1 product:Fedora component:foo",
+                "Watching 28 bugs.")
+            self.assertResponse(
+                "config plugins.bz.watches.test1.url" +
+                    " file://plugins/Bz/testdata/bz.test1.pickle.1",
+                "The operation succeeded.")
+            expected = [
+                "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                    " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+                "Polled 1 watch."
+            ]
+            self.assertResponses("watchpoll test1", expected)
+            key = shared.watch_key(config.watch_config('test1'))
+            follower = shared.Store('bz.shared.db', plugin._PickleBug)
+            self.assertFalse(follower.lead(key))
+            events = follower.read(key, 0)
+            self.assertEqual([kind for _, kind, _ in events],
+                             ['changes', 'reload'])
+            self.assertEqual([(o.status, n.status) for o, n in events[0][2]],
+                             [(self._sharedBug('0').status, 'OPEN')])
+            self.assertEqual(len(events[1][2]), 28)
+            self.assertEqual(events[1][2][768769].status, 'OPEN')
+            # A new follower starts from the latest snapshot.
+            self.assertEqual(
+                [(seq, kind) for seq, kind, _ in follower.read(key, None)],
+                [(seq, kind) for seq, kind, _ in events[1:]])
+        finally:
+            conf.supybot.plugins.Bz.sharedStore.setValue('')
+
+    def testSharedFailover(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        key = shared.watch_key(config.watch_config('test1'))
+        leader = shared.Store('bz.shared.db', plugin._PickleBug)
+        self.assertTrue(leader.lead(key))
+        conf.supybot.plugins.Bz.sharedStore.setValue('bz.shared.db')
+        old, new = self._sharedBug('0'), self._sharedBug('1')
+        bugs = dict([(b.id, b) for b in dataset.load(
+                        'plugins/Bz/testdata/bz.test1.pickle.0')])
+        message = "Bug 768769: Missing dependency: wget, new state: %s -" \
+                      " https://bugzilla.redhat.com/show_bug.cgi?id=768769"
+        try:
+            # Changes before the latest snapshot are not reported.
+            leader.publish_changes(key, [(new, old)])
+            leader.publish_reload(key, bugs)
+            leader.publish_changes(key, [(old, new)])
+            self.assertResponses("watchpoll test1",
+                                 [message % 'OPEN', "Polled 1 watch."])
+            # A restarted follower resumes where it stopped.
+            self.assertResponses('reload Bz',
+                                 ['Bz reinitialized with 2 watches.',
+                                  'The operation succeeded.'])
+            leader.publish_changes(key, [(new, old)])
+            self.assertResponses("watchpoll test1",
+                                 [message % old.status, "Polled 1 watch."])
+            # When the leader exits, the follower polls bugzilla itself.
+            leader.close()
+            self.assertResponse("watchpoll test1", "Polled 1 watch.")
+            self.assertFalse(
+                shared.Store('bz.shared.db', plugin._PickleBug).lead(key))
+            self.assertResponse(
+                "config plugins.bz.watches.test1.url" +
+                    " file://plugins/Bz/testdata/bz.test1.pickle.1",
+                "The operation succeeded.")
+            self.assertResponses("watchpoll test1",
+                                 [message % 'OPEN', "Polled 1 watch."])
+        finally:
+            conf.supybot.plugins.Bz.sharedStore.setValue('')
+            leader.close()
+
+    def testSharedOtherWatch(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        # Another instance leading another watch doesn't lead this one.
+        other = shared.Store('bz.shared.db', plugin._PickleBug)
+        self.assertTrue(other.lead('http://other.example.com/xmlrpc.cgi'))
+        conf.supybot.plugins.Bz.sharedStore.setValue('bz.shared.db')
+        try:
+            self.assertResponse(
+                "config plugins.bz.watches.test1.url" +
+                    " file://plugins/Bz/testdata/bz.test1.pickle.1",
+                "The operation succeeded.")
+            expected = [
+                "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                    " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+                "Polled 1 watch."
+            ]
+            self.assertResponses("watchpoll test1", expected)
+        finally:
+            conf.supybot.plugins.Bz.sharedStore.setValue('')
+            other.close()
+
+    def testSharedLeadThreads(self):
+        store = shared.Store('bz.shared.db', plugin._PickleBug)
+        start = threading.Event()
+        results = []
+
+        def lead():
+            start.wait()
+            results.append(store.lead('key'))
+
+        threads = [threading.Thread(target=lead) for dummy in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [True] * 8)
+        store.close()
+        other = shared.Store('bz.shared.db', plugin._PickleBug)
+        self.assertTrue(other.lead('key'))
+        other.close()
+
+    def testWarmStart(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        expected = ['Bz reinitialized with 2 watches.',
+                    'The operation succeeded.'
+        ]
+        self.assertResponses('reload Bz', expected)
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url" +
+                " file://plugins/Bz/testdata/bz.test1.pickle.1",
+            "The operation succeeded.")
+        expected = [
+            "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                " https://bugzilla.redhat.com/show_bug.cgi?id=768769",
+            "Polled 1 watch."
+        ]
+        self.assertResponses("watchpoll test1", expected)
+
+    def testIncrementalFetch(self):
+        server = FakeBugzilla('plugins/Bz/testdata/bz.test1.pickle.0')
+        try:
+            self._addFakeWatch(server)
+            self.assertEqual(len(server.requested), 28)
+            old = dict([(b.id, _fake_change_time(b).value)
+                        for b in server.bugs])
+            server.load('plugins/Bz/testdata/bz.test1.pickle.1')
+            changed = [b.id for b in server.bugs
+                       if old.get(b.id) != _fake_change_time(b).value]
+            self.assertTrue(0 < len(changed) < 28)
+            expected = [
+                "Bug 768769: Missing dependency: wget, new state: OPEN -"
+                    " http://127.0.0.1:%d/show_bug.cgi?id=768769" %
+                    server.server.server_address[1],
+                "Polled 1 watch."
+            ]
+            server.requested = []
+            self.assertResponses("watchpoll fake", expected)
+            self.assertEqual(sorted(server.requested), sorted(changed))
+            server.requested = []
+            self.assertResponse("watchpoll fake", "Polled 1 watch.")
+            self.assertEqual(server.requested, [])
+            watch = self.irc.getCallback('Bz').watches.get_by_name('fake')
+            self.assertEqual(len(watch.bugs), len(server.bugs))
+        finally:
+            server.stop()
+
+    def testFetchInterleavedWithQuery(self):
+        server = FakeBugzilla('plugins/Bz/testdata/bz.test1.pickle.0')
+        try:
+            self._addFakeWatch(server)
+            self.assertResponse(
+                "config plugins.bz.watches.fake.firstbug 760000",
+                "The operation succeeded.")
+            self.assertResponse(
+                "watchquery fake product:Fedora component:foo",
+                "Watching 27 bugs.")
+            server.load('plugins/Bz/testdata/bz.test1.pickle.1')
+            watch = self.irc.getCallback('Bz').watches.get_by_name('fake')
+            checkpoints = []
+
+            def checkpoint():
+                # The poll has found its bugs, let watchquery change them.
+                checkpoints.append(len(checkpoints))
+                self.assertResponse(
+                    "config plugins.bz.watches.fake.firstbug 0",
+                    "The operation succeeded.")
+                self.assertResponse(
+                    "watchquery fake product:Fedora component:bar",
+                    "Watching 28 bugs.")
+
+            changes = []
+            watch.poll(lambda old, new, w: changes.append((old, new)),
+                       checkpoint=checkpoint)
+            self.assertEqual(checkpoints, [0])
+            self.assertEqual(changes, [])
+            self.assertEqual(sorted(watch.bugs.keys()),
+                             sorted([b.id for b in server.bugs]))
+            self.assertEqual(watch.bugs[768769].status, 'OPEN')
+        finally:
+            server.stop()
+
+    def testQueryChangedReload(self):
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.query product:Fedora",
+            "The operation succeeded.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url" +
+                " file://plugins/Bz/testdata/bz.test1.pickle.1",
+            "The operation succeeded.")
+        self.assertResponses("watchpoll test1", ["Polled 1 watch."])
+
+    def testFirstbugChangedReload(self):
+        self.assertResponse(
+            "config plugins.bz.watches.test1.firstbug 760000",
+            "The operation succeeded.")
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 27 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.firstbug 0",
+            "The operation succeeded.")
+        self.assertResponses("watchpoll test1", ["Polled 1 watch."])
+        watch = self.irc.getCallback('Bz').watches.get_by_name('test1')
+        self.assertEqual(len(watch.bugs), 28)
+
+    def testPollRemoved(self):
+        bugs = dataset.load('plugins/Bz/testdata/bz.test1.pickle.0')
+        dataset.write([b for b in bugs if b.id != 757351], 'bz.test1.d')
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 28 bugs.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.reportremoved True",
+            "The operation succeeded.")
+        self.assertResponse(
+            "config plugins.bz.watches.test1.url file://bz.test1.d",
+            "The operation succeeded.")
+        expected = [
+            "Bug 757351: [abrt] fedora-review-0.1.1-1.fc16:"
+                " transaction.py:35:parseSpec:ValueError: can't parse"
+                " specfile, left watch"
+                " - https://bugzilla.redhat.com/show_bug.cgi?id=757351",
+            "Polled 1 watch."
+        ]
+        self.assertResponses("watchpoll test1", expected)
+        self.assertNoResponse("what about 757351?", 1, usePrefixChar=False)
+        self.assertResponse("watchquery test1 product:Fedora component:foo",
+                            "Watching 27 bugs.")
+
     def testSnarf(self):
         self.assertResponse("watchquery test1 product:Fedora component:foo",
                             "Watching 28 bugs.")
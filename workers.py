@@ -0,0 +1,156 @@
+###
+# Copyright (c) 2011-2012, Mike Mueller <mike.mueller@panopticdev.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Optional pool of worker processes running the reading, diffing and
+pickling of bugs out of the bot process, see the workerProcesses option.
+Workers return only the changes to the bot, see compact() and expand().
+"""
+
+import logging
+import multiprocessing
+import threading
+
+import config
+
+
+def compact(changes, fields):
+    """
+    Return changes (see plugin._diff()) as a list of (id, values)
+    events: values is None for removed bugs, else a dict with the
+    values of all fields differing from the old bug. Comments added
+    to the old ones are sent as just the new ones, in 'longdescs+'.
+    """
+    events = []
+    for oldbug, newbug in changes:
+        if not newbug:
+            events.append((oldbug.id, None))
+            continue
+        values = {}
+        for field in fields:
+            value = getattr(newbug, field)
+            if not oldbug:
+                values[field] = value
+                continue
+            old = getattr(oldbug, field, None)
+            if field == 'longdescs' and value[:len(old)] == old:
+                if len(value) > len(old):
+                    values['longdescs+'] = value[len(old):]
+            elif value != old:
+                values[field] = value
+        events.append((newbug.id, values))
+    return events
+
+
+def expand(bugs, events, bug_class):
+    """
+    Apply events from compact() to the dict of bugs by id, changed
+    bugs are replaced by new bug_class instances. Return the changes,
+    see plugin._diff().
+    """
+    changes = []
+    for id_, values in events:
+        oldbug = bugs.get(id_)
+        if values is None:
+            if oldbug:
+                del bugs[id_]
+                changes.append((oldbug, None))
+            continue
+        bug = bug_class()
+        if oldbug:
+            bug.__dict__.update(oldbug.__dict__)
+        if 'longdescs+' in values:
+            bug.longdescs = oldbug.longdescs + values.pop('longdescs+')
+        bug.__dict__.update(values)
+        bugs[id_] = bug
+        changes.append((oldbug, bug))
+    return changes
+
+
+def _init_worker():
+    ''' Run in each new worker process: disable all logging. '''
+    logging.disable(logging.CRITICAL)
+
+
+class Messages(object):
+    """
+    Stands in for a logger in worker processes, the messages are
+    logged by the parent. The processes are forked from the running
+    bot, where other threads (supybot's driver and commands, the
+    fetcher of a reloaded plugin) might hold the lock of a log handler
+    at the time. The child gets a copy of such a lock which is never
+    released, so logging there could hang.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def debug(self, message):
+        ''' Add a debug message. '''
+        self.messages.append((logging.DEBUG, message))
+
+    def warning(self, message):
+        ''' Add a warning. '''
+        self.messages.append((logging.WARNING, message))
+
+
+class Workers(object):
+    """
+    The worker process pool. The processes are forked when the plugin
+    is loaded, while other threads are running. Code run in them must
+    not take locks these threads might hold, notably logging; see
+    Messages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def start(self):
+        ''' Fork workerProcesses processes, if any. '''
+        size = config.global_option('workerProcesses').value
+        with self._lock:
+            if size and not self._pool:
+                self._pool = multiprocessing.Pool(size, _init_worker)
+
+    def get(self):
+        ''' Return the pool, or None if not enabled. '''
+        with self._lock:
+            return self._pool
+
+    def stop(self):
+        ''' Kill all worker processes. '''
+        with self._lock:
+            if self._pool:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: